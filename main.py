@@ -1,22 +1,77 @@
 # main.py
 import os
+import time
+import logging
 import asyncio
-from typing import Any, Dict, List, Optional
-from pydantic import BaseModel
-from fastapi import FastAPI, HTTPException
+import functools
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from pydantic import BaseModel, ConfigDict, Field
+from fastapi import FastAPI, HTTPException, Request
 import httpx
+import orjson
 from dotenv import load_dotenv
 
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 TMDB_API_KEY = os.getenv("TMDB_API_KEY")
 WATCH_REGION_DEFAULT = os.getenv("WATCH_REGION", "US")
 if not TMDB_API_KEY:
     raise RuntimeError("Please set TMDB_API_KEY in .env")
 
 TMDB_BASE = "https://api.themoviedb.org/3"
-
-app = FastAPI(title="Agentic Movie Recommender (MCP/A2A/ACP demo)")
+TMDB_MAX_CONCURRENCY = 30  # in-flight TMDb requests; their rate limit is ~40 req / 10s
+TMDB_RETRY_AFTER_MAX = 10.0
+GENRE_MAP_TTL = 24 * 60 * 60  # genre list almost never changes
+
+# seconds to keep a TMDb response in memory, by path prefix (first match wins)
+CACHE_TTLS = (
+    ("/genre/movie/list", GENRE_MAP_TTL),
+    ("/search", 30 * 60),
+    ("/discover", 10 * 60),
+    ("/movie/", 60 * 60),  # details, similar and watch/providers
+)
+CACHE_TTL_DEFAULT = 10 * 60
+CACHE_MAX_ENTRIES = 2048  # search keys are user-supplied text, so the cache must be bounded
+POPULAR_REFRESH_INTERVAL = 10 * 60
+POPULAR_MAX_AGE = 2 * POPULAR_REFRESH_INTERVAL  # older than this, the warmer has stalled
+
+
+def cache_ttl(path: str) -> int:
+    for prefix, ttl in CACHE_TTLS:
+        if path.startswith(prefix):
+            return ttl
+    return CACHE_TTL_DEFAULT
+
+
+# size-bounded dict that evicts the least recently used entry
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        return self._data.pop(key, None)
 
 # -------------------------
 # Simple A2A Bus (in-process)
@@ -26,37 +81,114 @@ app = FastAPI(title="Agentic Movie Recommender (MCP/A2A/ACP demo)")
 class AgentBus:
     def __init__(self):
         self.agents: Dict[str, Any] = {}
+        # bound agent.handle methods, so send() is a single lookup and call
+        self.handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]] = {}
 
     def register(self, name: str, agent: Any):
         self.agents[name] = agent
+        self.handlers[name] = agent.handle
 
     async def send(self, to: str, message: Dict[str, Any]) -> Dict[str, Any]:
-        agent = self.agents.get(to)
-        if not agent:
-            raise RuntimeError(f"Agent '{to}' not registered")
-        return await agent.handle(message)
+        try:
+            handler = self.handlers[to]
+        except KeyError:
+            raise RuntimeError(f"Agent '{to}' not registered") from None
+        return await handler(message)
 
 # -------------------------
 # MCPClient: wraps TMDb API
 # -------------------------
 
 
+def _retry_after(r: httpx.Response) -> float:
+    try:
+        delay = float(r.headers.get("retry-after", 1))
+    except ValueError:
+        delay = 1.0
+    return min(max(delay, 0.0), TMDB_RETRY_AFTER_MAX)
+
+
 class MCPClient:
     def __init__(self, api_key: str):
         self.api_key = api_key
-        self.client = httpx.AsyncClient(timeout=10.0)
+        # HTTP/2 lets the parallel watch-provider lookups multiplex over one TLS connection
+        self.client = httpx.AsyncClient(
+            base_url=TMDB_BASE,
+            params={"api_key": api_key},  # merged into every request's query string
+            timeout=10.0,
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30),
+        )
+        self._sem = asyncio.Semaphore(TMDB_MAX_CONCURRENCY)
+        # (path, sorted params) -> (fetched_at, etag, payload); cached payloads are shared, don't mutate them
+        self._cache = LRUCache(CACHE_MAX_ENTRIES)
+        # key -> task fetching it right now, shared by concurrent callers
+        self._inflight: Dict[Tuple, asyncio.Task] = {}
+        # genre name -> id, fetched once and refreshed after GENRE_MAP_TTL
+        self._genre_map: Optional[Dict[str, int]] = None
+        self._genre_map_ts = 0.0
+        self._genre_map_lock = asyncio.Lock()
+        # first page of popular movies, kept warm by keep_popular_warm()
+        self._popular_cache: List[Dict[str, Any]] = []
+        self._popular_ts = 0.0
+
+    async def _fetch(self, path: str, params: Optional[Dict[str, Any]], stale: Optional[Tuple] = None) -> Tuple:
+        headers = {}
+        if stale and stale[1]:
+            # revalidate the expired entry; a 304 carries no body to download or decode
+            headers["If-None-Match"] = stale[1]
+        async with self._sem:
+            r = await self.client.get(path, params=params, headers=headers)
+        if r.status_code == 429:
+            # rate limited: wait as told (without holding a slot) and retry once
+            await asyncio.sleep(_retry_after(r))
+            async with self._sem:
+                r = await self.client.get(path, params=params, headers=headers)
+        if r.status_code == 304 and stale:
+            return (time.monotonic(), stale[1], stale[2])
+        r.raise_for_status()
+        return (time.monotonic(), r.headers.get("etag"), orjson.loads(r.content))
 
     async def _get(self, path: str, params: Dict[str, Any] = None):
-        params = params or {}
-        params["api_key"] = self.api_key
-        url = f"{TMDB_BASE}{path}"
-        r = await self.client.get(url, params=params)
-        r.raise_for_status()
-        return r.json()
+        key = (path, tuple(sorted(params.items())) if params else ())
+        entry = self._cache.get(key)
+        if entry:
+            if time.monotonic() - entry[0] < cache_ttl(path):
+                return entry[2]
+            if not entry[1]:
+                # expired and nothing to revalidate with
+                self._cache.pop(key)
+                entry = None
+        # single-flight: the fetch runs as its own task so cancelling any one caller
+        # (including the one that started it) never cancels the others
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._refresh(key, path, params, entry))
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._refresh_done, key))
+        return await asyncio.shield(task)
+
+    async def _refresh(self, key: Tuple, path: str, params: Optional[Dict[str, Any]], stale: Optional[Tuple]):
+        entry = await self._fetch(path, params, stale)
+        # fill the cache before the waiters wake up
+        self._cache.put(key, entry)
+        return entry[2]
+
+    def _refresh_done(self, key: Tuple, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved in case every caller was cancelled
 
     async def search_movie(self, query: str, page: int = 1):
         return await self._get("/search/movie", {"query": query, "page": page})
 
+    async def resolve_seed(self, seed: str) -> Optional[int]:
+        # TMDb id of the top search hit; repeat seeds are served by the bounded /search cache
+        search = await self.search_movie(seed.strip().lower())
+        results = search.get("results", [])
+        return results[0]["id"] if results else None
+
     async def get_movie_details(self, movie_id: int):
         return await self._get(f"/movie/{movie_id}")
 
@@ -70,13 +202,49 @@ class MCPClient:
         # returns a structure with keys per country
         return await self._get(f"/movie/{movie_id}/watch/providers")
 
+    def _genre_map_fresh(self) -> bool:
+        return self._genre_map is not None and time.monotonic() - self._genre_map_ts < GENRE_MAP_TTL
+
     async def get_genre_map(self):
-        data = await self._get("/genre/movie/list")
-        return {g["name"].lower(): g["id"] for g in data.get("genres", [])}
+        if self._genre_map_fresh():
+            return self._genre_map
+        async with self._genre_map_lock:
+            # another caller may have refreshed it while we waited
+            if self._genre_map_fresh():
+                return self._genre_map
+            data = await self._get("/genre/movie/list")
+            self._genre_map = {g["name"].lower(): g["id"] for g in data.get("genres", [])}
+            self._genre_map_ts = time.monotonic()
+            return self._genre_map
+
+    async def refresh_popular(self):
+        discover = await self.discover_by_genres("", sort_by="popularity.desc", page=1)
+        self._popular_cache = discover.get("results", [])
+        self._popular_ts = time.monotonic()
+
+    def popular_movies(self, num: int) -> List[Dict[str, Any]]:
+        # empty when the prewarmed list is missing or stale
+        if time.monotonic() - self._popular_ts > POPULAR_MAX_AGE:
+            return []
+        return self._popular_cache[:num]
 
     async def close(self):
+        pending = list(self._inflight.values())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
         await self.client.aclose()
 
+
+async def keep_popular_warm(mcp: MCPClient, interval: int = POPULAR_REFRESH_INTERVAL):
+    while True:
+        try:
+            await mcp.refresh_popular()
+        except Exception:
+            # keep the previous list; RecommenderAgent falls back to a live call once it is stale
+            logger.exception("refreshing popular movies failed")
+        await asyncio.sleep(interval)
+
 # -------------------------
 # Agent base
 # -------------------------
@@ -126,51 +294,62 @@ class UserIntentAgent(Agent):
 # -------------------------
 
 
+# raised by RecommenderAgent intent handlers; the message is sent back as the reason
+class RecommendError(Exception):
+    pass
+
+
 class RecommenderAgent(Agent):
+    def __init__(self, name: str, bus: AgentBus, mcp: MCPClient):
+        super().__init__(name, bus, mcp)
+        # intent type -> handler returning the candidate TMDb results
+        self._handlers = {
+            "seed_movie": self._seed,
+            "genre": self._genre,
+            "query": self._query,
+            "popular": self._popular,
+        }
+
     async def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:
         intent = message.get("intent", {})
-        typ = intent.get("type")
+        handler = self._handlers.get(intent.get("type"), self._popular)
+        try:
+            items = await handler(intent)
+        except RecommendError as e:
+            return {"status": "error", "reason": str(e)}
+
+        # raw TMDb results (shared with the cache, don't mutate); recommend() picks the fields it returns
+        return {"status": "ok", "movies": items}
+
+    async def _seed(self, intent: Dict[str, Any]) -> List[Dict[str, Any]]:
+        movie_id = await self.mcp.resolve_seed(intent.get("seed_movie"))
+        if movie_id is None:
+            raise RecommendError("seed movie not found")
+        similar = await self.mcp.get_similar(movie_id, page=1)
+        return similar.get("results", [])[:intent.get("num", 5)]
+
+    async def _genre(self, intent: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # map genre name -> id
+        genre_name = intent.get("genre", "").lower()
+        genre_map = await self.mcp.get_genre_map()
+        genre_id = genre_map.get(genre_name)
+        if not genre_id:
+            raise RecommendError(f"unknown genre '{genre_name}'")
+        discover = await self.mcp.discover_by_genres(str(genre_id), page=1)
+        return discover.get("results", [])[:intent.get("num", 5)]
+
+    async def _query(self, intent: Dict[str, Any]) -> List[Dict[str, Any]]:
+        search = await self.mcp.search_movie(intent.get("query"))
+        return search.get("results", [])[:intent.get("num", 5)]
+
+    async def _popular(self, intent: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # fallback: popular, served from the prewarmed list when available
         num = intent.get("num", 5)
-
-        if typ == "seed_movie":
-            seed = intent.get("seed_movie")
-            # find movie id
-            search = await self.mcp.search_movie(seed)
-            results = search.get("results", [])
-            if not results:
-                return {"status": "error", "reason": "seed movie not found"}
-            movie_id = results[0]["id"]
-            similar = await self.mcp.get_similar(movie_id, page=1)
-            items = similar.get("results", [])[:num]
-        elif typ == "genre":
-            # map genre name -> id
-            genre_name = intent.get("genre", "").lower()
-            genre_map = await self.mcp.get_genre_map()
-            genre_id = genre_map.get(genre_name)
-            if not genre_id:
-                return {"status": "error", "reason": f"unknown genre '{genre_name}'"}
-            discover = await self.mcp.discover_by_genres(str(genre_id), page=1)
-            items = discover.get("results", [])[:num]
-        elif typ == "query":
-            q = intent.get("query")
-            search = await self.mcp.search_movie(q)
-            items = search.get("results", [])[:num]
-        else:
-            # fallback: popular (discover by popularity)
+        items = self.mcp.popular_movies(num)
+        if not items:
             discover = await self.mcp.discover_by_genres("", sort_by="popularity.desc", page=1)
             items = discover.get("results", [])[:num]
-
-        # normalize to a compact movie descriptor
-        movies = []
-        for it in items:
-            movies.append({
-                "id": it.get("id"),
-                "title": it.get("title"),
-                "overview": it.get("overview"),
-                "release_date": it.get("release_date"),
-                "popularity": it.get("popularity"),
-            })
-        return {"status": "ok", "movies": movies}
+        return items
 
 # -------------------------
 # AvailabilityAgent
@@ -180,6 +359,11 @@ class RecommenderAgent(Agent):
 
 
 class AvailabilityAgent(Agent):
+    def __init__(self, name: str, bus: AgentBus, mcp: MCPClient):
+        super().__init__(name, bus, mcp)
+        # (movie_id, region) -> (TMDb payload it was built from, providers); shared, don't mutate
+        self._providers = LRUCache(CACHE_MAX_ENTRIES)
+
     async def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:
         movie_id = message.get("movie_id")
         region = message.get("region", WATCH_REGION_DEFAULT)
@@ -189,28 +373,61 @@ class AvailabilityAgent(Agent):
         country_info = wp.get("results", {}).get(region)
         if not country_info:
             return {"status": "ok", "providers": []}
+        # the cached payload object only changes when MCPClient refetches it,
+        # so reuse the providers we built from it last time
+        key = (movie_id, region)
+        built = self._providers.get(key)
+        if built and built[0] is wp:
+            return {"status": "ok", "providers": built[1]}
         # TMDb returns keys like 'flatrate', 'rent', 'buy' with provider lists
-        providers = {}
-        for k in ("flatrate", "rent", "buy"):
-            lst = country_info.get(k) or []
-            providers[k] = [{"provider_id": p["provider_id"], "provider_name": p["provider_name"],
-                             "display_priority": p.get("display_priority")} for p in lst]
+        providers = {"flatrate": [], "rent": [], "buy": []}
+        for k in providers:
+            lst = country_info.get(k)
+            if lst:
+                providers[k] = [{"provider_id": p["provider_id"], "provider_name": p["provider_name"],
+                                 "display_priority": p.get("display_priority")} for p in lst]
+        self._providers.put(key, (wp, providers))
         return {"status": "ok", "providers": providers}
 
 
 # -------------------------
 # Bootstrapping bus, MCP, agents
 # -------------------------
-bus = AgentBus()
-mcp = MCPClient(TMDB_API_KEY)
 
-user_intent_agent = UserIntentAgent("UserIntentAgent", bus, mcp)
-recommender_agent = RecommenderAgent("RecommenderAgent", bus, mcp)
-availability_agent = AvailabilityAgent("AvailabilityAgent", bus, mcp)
 
-bus.register("UserIntentAgent", user_intent_agent)
-bus.register("RecommenderAgent", recommender_agent)
-bus.register("AvailabilityAgent", availability_agent)
+def build_bus(mcp: MCPClient) -> AgentBus:
+    bus = AgentBus()
+
+    user_intent_agent = UserIntentAgent("UserIntentAgent", bus, mcp)
+    recommender_agent = RecommenderAgent("RecommenderAgent", bus, mcp)
+    availability_agent = AvailabilityAgent("AvailabilityAgent", bus, mcp)
+
+    bus.register("UserIntentAgent", user_intent_agent)
+    bus.register("RecommenderAgent", recommender_agent)
+    bus.register("AvailabilityAgent", availability_agent)
+    return bus
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the httpx pool is created on, and closed with, the app's own event loop
+    mcp = MCPClient(TMDB_API_KEY)
+    warmer = None
+    try:
+        app.state.mcp = mcp
+        app.state.bus = build_bus(mcp)
+        warmer = asyncio.create_task(keep_popular_warm(mcp))
+        yield
+    finally:
+        if warmer:
+            warmer.cancel()
+            # let it unwind before the pool it may be using goes away
+            with suppress(asyncio.CancelledError):
+                await warmer
+        await mcp.close()
+
+
+app = FastAPI(title="Agentic Movie Recommender (MCP/A2A/ACP demo)", lifespan=lifespan)
 
 # -------------------------
 # API models and endpoints
@@ -227,27 +444,34 @@ class RecommendRequest(BaseModel):
 
 
 class ProviderInfo(BaseModel):
-    flatrate: List[Dict[str, Any]] = []
-    rent: List[Dict[str, Any]] = []
-    buy: List[Dict[str, Any]] = []
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
+    flatrate: List[Dict[str, Any]] = Field(default_factory=list)
+    rent: List[Dict[str, Any]] = Field(default_factory=list)
+    buy: List[Dict[str, Any]] = Field(default_factory=list)
 
 
 class MovieItem(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     id: int
     title: str
     overview: Optional[str]
     release_date: Optional[str]
     popularity: Optional[float]
-    providers: Optional[ProviderInfo] = ProviderInfo()
+    providers: Optional[ProviderInfo] = Field(default_factory=ProviderInfo)
 
 
 class RecommendResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     status: str
     movies: List[MovieItem]
 
 
 @app.post("/recommend", response_model=RecommendResponse)
-async def recommend(req: RecommendRequest):
+async def recommend(req: RecommendRequest, request: Request):
+    bus = request.app.state.bus
     # 1. UserIntentAgent
     intent_msg = {"seed_movie": req.seed_movie, "genre": req.genre,
                   "query": req.query, "num": req.num, "region": req.region}
@@ -261,36 +485,34 @@ async def recommend(req: RecommendRequest):
     if rec_resp.get("status") != "ok":
         raise HTTPException(status_code=400, detail=rec_resp.get(
             "reason", "recommendation failed"))
-    movies = rec_resp["movies"]
+    # drop repeated ids so each movie gets a single provider lookup
+    seen = set()
+    movies = [m for m in rec_resp["movies"] if not (m["id"] in seen or seen.add(m["id"]))]
 
-    # 3. For each movie, ask AvailabilityAgent via A2A
+    # 3. For each movie, ask AvailabilityAgent via A2A; the lookups run concurrently,
+    # so this step costs about as long as the slowest one (search -> similar can't overlap)
     async def enrich(m):
         prov = await bus.send("AvailabilityAgent", {"movie_id": m["id"], "region": req.region})
-        providers = prov.get("providers", {})
-        # normalize to our MovieItem
-        return MovieItem(
-            id=m["id"],
-            title=m.get("title"),
-            overview=m.get("overview"),
-            release_date=m.get("release_date"),
-            popularity=m.get("popularity"),
-            providers=providers
-        )
+        # plain dict: response_model validates the whole response once on the way out
+        return {
+            "id": m["id"],
+            "title": m.get("title"),
+            "overview": m.get("overview"),
+            "release_date": m.get("release_date"),
+            "popularity": m.get("popularity"),
+            "providers": prov.get("providers") or {},
+        }
     tasks = [enrich(m) for m in movies]
     enriched = await asyncio.gather(*tasks)
     return {"status": "ok", "movies": enriched}
 
 
 @app.post("/where_to_watch")
-async def where_to_watch(movie_id: int, region: Optional[str] = WATCH_REGION_DEFAULT):
+async def where_to_watch(request: Request, movie_id: int, region: Optional[str] = WATCH_REGION_DEFAULT):
+    bus = request.app.state.bus
     # direct call to AvailabilityAgent
     resp = await bus.send("AvailabilityAgent", {"movie_id": movie_id, "region": region})
     if resp.get("status") != "ok":
         raise HTTPException(
             status_code=400, detail=resp.get("reason", "failed"))
     return resp
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    await mcp.close()
@@ -1,11 +1,30 @@
+import asyncio
 import pytest
-from httpx import AsyncClient
-from main import app
+import main
+from contextlib import asynccontextmanager
+from httpx import ASGITransport, AsyncClient, HTTPStatusError, MockTransport, Response
+from main import TMDB_BASE, LRUCache, MCPClient, app
+
+
+@asynccontextmanager
+async def client():
+    # ASGITransport doesn't send lifespan events, so run the app's lifespan ourselves
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as ac:
+            yield ac
+
+
+async def mock_mcp(handler):
+    # MCPClient whose TMDb traffic goes to `handler` instead of the network
+    mcp = MCPClient("test-key")
+    await mcp.client.aclose()
+    mcp.client = AsyncClient(transport=MockTransport(handler), base_url=TMDB_BASE)
+    return mcp
 
 
 @pytest.mark.asyncio
 async def test_recommend_seed_movie():
-    async with AsyncClient(app=app, base_url="http://test") as ac:
+    async with client() as ac:
         response = await ac.post("/recommend", json={
             "user_id": "tester",
             "seed_movie": "Inception",
@@ -24,7 +43,7 @@ async def test_recommend_seed_movie():
 
 @pytest.mark.asyncio
 async def test_recommend_query():
-    async with AsyncClient(app=app, base_url="http://test") as ac:
+    async with client() as ac:
         response = await ac.post("/recommend", json={
             "user_id": "tester",
             "query": "Batman",
@@ -39,7 +58,7 @@ async def test_recommend_query():
 
 @pytest.mark.asyncio
 async def test_recommend_genre():
-    async with AsyncClient(app=app, base_url="http://test") as ac:
+    async with client() as ac:
         response = await ac.post("/recommend", json={
             "user_id": "tester",
             "genre": "action",
@@ -50,3 +69,237 @@ async def test_recommend_genre():
     data = response.json()
     assert data["status"] == "ok"
     assert len(data["movies"]) > 0
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert len(cache) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_waiter_survives_owner_cancellation():
+    release = asyncio.Event()
+
+    async def handler(request):
+        await release.wait()
+        return Response(200, json={"results": []})
+
+    mcp = await mock_mcp(handler)
+    owner = asyncio.create_task(mcp._get("/discover/movie"))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(mcp._get("/discover/movie"))
+    await asyncio.sleep(0)
+    owner.cancel()
+    release.set()
+    assert await waiter == {"results": []}
+    with pytest.raises(asyncio.CancelledError):
+        await owner
+    await mcp.close()
+
+
+@pytest.mark.asyncio
+async def test_popular_movies_expire_when_warmer_stalls():
+    async def handler(request):
+        return Response(200, json={"results": [{"id": 1}, {"id": 2}]})
+
+    mcp = await mock_mcp(handler)
+    await mcp.refresh_popular()
+    assert mcp.popular_movies(1) == [{"id": 1}]
+    mcp._popular_ts -= main.POPULAR_MAX_AGE + 1
+    assert mcp.popular_movies(1) == []
+    await mcp.close()
+
+
+@pytest.mark.asyncio
+async def test_get_serves_cache_hit_within_ttl():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        return Response(200, json={"results": [{"id": 1}]})
+
+    mcp = await mock_mcp(handler)
+    first = await mcp._get("/search/movie", {"query": "Alien", "page": 1})
+    second = await mcp._get("/search/movie", {"page": 1, "query": "Alien"})
+    assert second is first
+    assert len(calls) == 1
+    await mcp.close()
+
+
+@pytest.mark.asyncio
+async def test_get_revalidates_expired_entry_with_etag():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if request.headers.get("if-none-match") == '"v1"':
+            return Response(304)
+        return Response(200, json={"genres": []}, headers={"ETag": '"v1"'})
+
+    mcp = await mock_mcp(handler)
+    first = await mcp._get("/genre/movie/list")
+    key = ("/genre/movie/list", ())
+    fetched_at, etag, payload = mcp._cache.get(key)
+    mcp._cache.put(key, (fetched_at - main.GENRE_MAP_TTL - 1, etag, payload))
+
+    second = await mcp._get("/genre/movie/list")
+    assert len(calls) == 2
+    assert "if-none-match" not in calls[0].headers
+    assert calls[1].headers["if-none-match"] == '"v1"'
+    assert second is first
+    # the 304 refreshed the entry, so the next call is a plain hit
+    assert await mcp._get("/genre/movie/list") is first
+    assert len(calls) == 2
+    await mcp.close()
+
+
+@pytest.mark.asyncio
+async def test_get_coalesces_concurrent_requests():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        return Response(200, json={"results": {}})
+
+    mcp = await mock_mcp(handler)
+    results = await asyncio.gather(*(mcp._get("/movie/42/watch/providers") for _ in range(10)))
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    await mcp.close()
+
+
+@pytest.mark.asyncio
+async def test_fetch_retries_once_after_429(monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(main.asyncio, "sleep", fake_sleep)
+    responses = [Response(429, headers={"Retry-After": "3"}), Response(200, json={"results": []})]
+
+    async def handler(request):
+        return responses.pop(0)
+
+    mcp = await mock_mcp(handler)
+    assert await mcp._get("/search/movie", {"query": "Heat"}) == {"results": []}
+    assert delays == [3.0]
+    await mcp.close()
+
+
+@pytest.mark.asyncio
+async def test_fetch_raises_after_second_429(monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(main.asyncio, "sleep", fake_sleep)
+
+    async def handler(request):
+        return Response(429, headers={"Retry-After": "120"})
+
+    mcp = await mock_mcp(handler)
+    with pytest.raises(HTTPStatusError):
+        await mcp._get("/search/movie", {"query": "Heat"})
+    assert delays == [main.TMDB_RETRY_AFTER_MAX]
+    await mcp.close()
+
+
+@pytest.mark.asyncio
+async def test_fetch_caps_concurrent_requests():
+    active = 0
+    peak = 0
+
+    async def handler(request):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return Response(200, json={"results": {}})
+
+    mcp = await mock_mcp(handler)
+    mcp._sem = asyncio.Semaphore(2)
+    await asyncio.gather(*(mcp.get_watch_providers(i) for i in range(6)))
+    assert peak == 2
+    await mcp.close()
+
+
+@pytest.mark.asyncio
+async def test_availability_memo_reuses_rebuilds_and_is_bounded(monkeypatch):
+    async def handler(request):
+        return Response(200, json={"results": {"US": {"flatrate": [{"provider_id": 8, "provider_name": "Netflix"}]}}})
+
+    monkeypatch.setattr(main, "CACHE_MAX_ENTRIES", 2)
+    mcp = await mock_mcp(handler)
+    agent = main.AvailabilityAgent("AvailabilityAgent", main.AgentBus(), mcp)
+    first = await agent.handle({"movie_id": 1, "region": "US"})
+    # same cached payload -> the memoised providers are reused
+    assert (await agent.handle({"movie_id": 1, "region": "US"}))["providers"] is first["providers"]
+    # expire the ETag-less entry so MCPClient refetches a new payload -> rebuilt
+    key = ("/movie/1/watch/providers", ())
+    fetched_at, etag, payload = mcp._cache.get(key)
+    mcp._cache.put(key, (fetched_at - main.cache_ttl(key[0]) - 1, etag, payload))
+    rebuilt = await agent.handle({"movie_id": 1, "region": "US"})
+    assert rebuilt["providers"] is not first["providers"]
+    assert rebuilt["providers"] == first["providers"]
+    for movie_id in (1, 2, 3):
+        resp = await agent.handle({"movie_id": movie_id, "region": "US"})
+        assert resp["providers"]["flatrate"][0]["provider_name"] == "Netflix"
+    assert len(agent._providers) == 2
+    await mcp.close()
+
+
+@pytest.mark.asyncio
+async def test_lifespan_shutdown_waits_for_warmer(monkeypatch):
+    started = asyncio.Event()
+    finished = []
+
+    async def fake_warm(mcp, interval=0):
+        started.set()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            finished.append(mcp.client.is_closed)
+
+    monkeypatch.setattr(main, "keep_popular_warm", fake_warm)
+    async with app.router.lifespan_context(app):
+        await started.wait()
+    # the warmer unwound while the client was still open
+    assert finished == [False]
+
+
+@pytest.mark.asyncio
+async def test_recommend_dedupes_movies_before_provider_lookups(monkeypatch):
+    provider_calls = []
+
+    async def handler(request):
+        path = request.url.path
+        if path.endswith("/search/movie"):
+            return Response(200, json={"results": [{"id": 10, "title": "Seed"}]})
+        if path.endswith("/movie/10/similar"):
+            movie = {"id": 7, "title": "Twin", "overview": None, "release_date": None, "popularity": 1.0}
+            return Response(200, json={"results": [movie, dict(movie)]})
+        provider_calls.append(path)
+        return Response(200, json={"results": {}})
+
+    async def no_warm(mcp, interval=0):
+        pass
+
+    monkeypatch.setattr(main, "keep_popular_warm", no_warm)
+    async with client() as ac:
+        mcp = app.state.mcp
+        await mcp.client.aclose()
+        mcp.client = AsyncClient(transport=MockTransport(handler), base_url=TMDB_BASE)
+        response = await ac.post("/recommend", json={"user_id": "tester", "seed_movie": "Seed", "num": 5})
+    assert response.status_code == 200
+    assert [m["id"] for m in response.json()["movies"]] == [7]
+    assert provider_calls == ["/3/movie/7/watch/providers"]